@@ -14,11 +14,13 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import array
 import chess.pgn
-import zobrist
 import numpy as np
-import statistics
 
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from fastboard import FastBoard
 from util import encode_move
 from pathlib import Path
 
@@ -32,224 +34,244 @@ from pathlib import Path
 # The generation result is an AssemblyScript source file.
 
 PLY_BOOK_LIMIT = 16
-ply_moves = [{} for _ in range(PLY_BOOK_LIMIT + 1)]
 
-move_occurences = [{} for _ in range(PLY_BOOK_LIMIT + 1)]
+# Number of games between progress reports
+PROGRESS_INTERVAL = 1000
 
-max_ply = 0
+# Opening line (ply, zobrist hash and encoded move) of a game, only containing moves of the non-losing side(s)
+GAME_LINE_DTYPE = np.dtype([('ply', np.uint8), ('hash', np.uint64), ('move', np.uint16)])
 
-print("Parsing chess games from pgn file ...")
-game_num = 0
-
-books = [
-    "pgn/fics2400.pgn",
-    "pgn/fics2600.pgn",
-    "pgn/fics2600ur.pgn",
-    "pgn/fics2400ur.pgn"
-]
-
-move_thresholds = [2 for i in range(PLY_BOOK_LIMIT + 1)]
-move_thresholds[0] = 10
-move_thresholds[1] = 10
 
 # First pass: count occurrences of moves to filter out unusual or rarely played openings
-for book in books:
-    pgn = open(book)
-    print("Analyzing games from ", book)
+# Returns the move occurrences per ply and the opening lines of all analyzed games from the given PGN file
+def analyze_pgn(path):
+    move_occurences = [Counter() for _ in range(PLY_BOOK_LIMIT + 1)]
+    game_lines = []
+    game_num = 0
+
+    pgn = open(path)
+    print("Analyzing games from ", path)
     while True:
-        game = chess.pgn.read_game(pgn)
-        if not game:
+        # Only read the headers first, so the moves of skipped games do not need to be parsed
+        offset = pgn.tell()
+        headers = chess.pgn.read_headers(pgn)
+        if not headers:
             break
 
-        result = game.headers['Result']
-        whiteElo = int(game.headers['WhiteElo'])
-        blackElo = int(game.headers['BlackElo'])
+        result = headers['Result']
+        whiteElo = int(headers['WhiteElo'])
+        blackElo = int(headers['BlackElo'])
         skipWhite = result == '0-1'
         skipBlack = result == '1-0'
 
         if whiteElo < 2000 or blackElo < 2000 or abs(whiteElo - blackElo) > 50:
             continue
 
+        pgn.seek(offset)
+        game = chess.pgn.read_game(pgn)
+
         game_num += 1
-        print("- analyzing game #", game_num)
-        board = game.board()
+        if game_num % PROGRESS_INTERVAL == 0:
+            print("- analyzed", game_num, "games from", path)
+        board = FastBoard(game.board())
+        game_line = []
         ply = 0
         for move in game.mainline_moves():
-            zobrist_hash = zobrist.calc_hash(board)
+            occurences = move_occurences[ply]
+            position_hash = board.hash
             moveFrom = move.from_square
             moveTo = move.to_square
-            encoded_move = encode_move(board.piece_at(moveFrom).piece_type, moveFrom, moveTo)
+            encoded_move = encode_move(board.piece_type_at(moveFrom), moveFrom, moveTo)
 
             isWhiteTurn = board.turn == chess.WHITE
             isBlackTurn = not isWhiteTurn
 
-            board.push(move)
+            board.make_move(moveFrom, moveTo, move.promotion)
 
             if (isWhiteTurn and not skipWhite) or (isBlackTurn and not skipBlack):
-                # Only include moves that were played in multiple games
-                if encoded_move in move_occurences[ply]:
-                    move_occurences[ply][encoded_move] += 1
-
-                    if move_occurences[ply][encoded_move] >= move_thresholds[ply]:
-                        if ply > max_ply:
-                            max_ply = ply
-
-                else:
-                    move_occurences[ply][encoded_move] = 1
+                game_line.append((ply, position_hash, encoded_move))
+                occurences[encoded_move] += 1
 
             ply += 1
 
             if ply > PLY_BOOK_LIMIT:
                 break
+
+        game_lines.append(np.array(game_line, dtype=GAME_LINE_DTYPE))
     pgn.close()
+    print("Analyzed", game_num, "games from", path)
+
+    return move_occurences, game_lines
+
+
+def main():
+    books = [
+        "pgn/fics2400.pgn",
+        "pgn/fics2600.pgn",
+        "pgn/fics2600ur.pgn",
+        "pgn/fics2400ur.pgn"
+    ]
+
+    move_thresholds = [2 for i in range(PLY_BOOK_LIMIT + 1)]
+    move_thresholds[0] = 10
+    move_thresholds[1] = 10
+
+    print("Parsing chess games from pgn file ...")
+
+    # Analyze all PGN files in parallel and merge the results
+    move_occurences = [Counter() for _ in range(PLY_BOOK_LIMIT + 1)]
+    games_cache = []
+    with ProcessPoolExecutor(max_workers=len(books)) as executor:
+        for book_occurences, game_lines in executor.map(analyze_pgn, books):
+            for ply, occurences in enumerate(book_occurences):
+                move_occurences[ply].update(occurences)
+            games_cache.extend(game_lines)
+
+    # Only include moves that were played in multiple games
+    max_ply = 0
+    reached_threshold = []
+    for ply, occurences in enumerate(move_occurences):
+        threshold = move_thresholds[ply]
+        reached_threshold.append({move for move, count in occurences.items() if count >= threshold})
+        if reached_threshold[ply]:
+            max_ply = ply
+
+    # Second pass: extract opening lines from the games cached during the first pass
+    print("Extracting opening lines ...")
+    # Book moves by position, with the ply packed into the upper bits of the 64 bit zobrist hash key
+    positions = defaultdict(set)
+    game_num = 0
+    for game_line in games_cache:
+        game_num += 1
+        if game_num % PROGRESS_INTERVAL == 0:
+            print("- extracted moves from", game_num, "games")
+        # tolist() converts all fields to Python ints, so the hash is never mixed with NumPy scalars
+        for ply, position_hash, encoded_move in game_line.tolist():
+            if encoded_move in reached_threshold[ply]:
+                positions[(ply << 64) | position_hash].add(encoded_move)
+
+            else:
+                break
 
-# Second pass: extract opening lines
-for book in books:
-    pgn = open(book)
-    print("Reading games from ", book)
-    while True:
-        game = chess.pgn.read_game(pgn)
-        if not game:
-            break
+    print("Preparing opening book list...")
 
-        result = game.headers['Result']
-        whiteElo = int(game.headers['WhiteElo'])
-        blackElo = int(game.headers['BlackElo'])
-        skipWhite = result == '0-1'
-        skipBlack = result == '1-0'
+    ply_moves = [[] for _ in range(PLY_BOOK_LIMIT + 1)]
+    for key, moves in positions.items():
+        ply_moves[key >> 64].append((key & 0xFFFFFFFFFFFFFFFF, moves))
 
-        if whiteElo < 2000 or blackElo < 2000 or abs(whiteElo - blackElo) > 50:
-            continue
+    book = array.array('I', [0 for _ in range(max_ply + 1)])
+    book[0] = max_ply
 
-        game_num += 1
-        print("- extracting moves from game #", game_num)
-        board = game.board()
-        ply = 0
-        for move in game.mainline_moves():
-            zobrist_hash = zobrist.calc_hash(board)
-            moveFrom = move.from_square
-            moveTo = move.to_square
-            encoded_move = encode_move(board.piece_at(moveFrom).piece_type, moveFrom, moveTo)
+    for idx in range(max_ply):
+        if len(ply_moves[idx]) == 0:
+            break
+        book[idx + 1] = len(book)         # Start index for the move list of the current ply
+        book.append(len(ply_moves[idx]))  # Number of entries (positions)
+        for zobrist_hash, moves in ply_moves[idx]:
+            # Split 64 bit hash into 2 32-bit entries
+            for i in range(2):
+                book.append(zobrist_hash & 0xFFFFFFFF)
+                zobrist_hash >>= 32
+
+            book.append(len(moves))
+            book.extend(moves)
+
+    print("Writing opening book list...")
+
+    out = open("../../assembly/opening-book-data.ts", "w")
+    out.write("/*\n")
+    out.write(" * A free and open source chess game using AssemblyScript and React\n")
+    out.write(" * Copyright (C) 2020 mhonert (https://github.com/mhonert)\n")
+    out.write(" *\n")
+    out.write(" * This program is free software: you can redistribute it and/or modify\n")
+    out.write(" * it under the terms of the GNU General Public License as published by\n")
+    out.write(" * the Free Software Foundation, either version 3 of the License, or\n")
+    out.write(" * (at your option) any later version.\n")
+    out.write(" *\n")
+    out.write(" * This program is distributed in the hope that it will be useful,\n")
+    out.write(" * but WITHOUT ANY WARRANTY; without even the implied warranty of\n")
+    out.write(" * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the\n")
+    out.write(" * GNU General Public License for more details.\n")
+    out.write(" *\n")
+    out.write(" * You should have received a copy of the GNU General Public License\n")
+    out.write(" * along with this program.  If not, see <https://www.gnu.org/licenses/>.\n*/\n\n")
+
+    out.write("/* _________________________________________________________________________\n\n")
+    out.write(" * Auto-generated opening book data file\n")
+    out.write(" *  Format:\n")
+    out.write(" *  Index\n")
+    out.write(" *  0: Number of plies in this book (BOOK_PLIES)\n")
+    out.write(" *  1 - BOOK_PLIES: Start index for the moves for this ply\n\n")
+    out.write(" *  For each ply:\n")
+    out.write(" *   - Number of entries for this ply\n")
+    out.write(" *     For each entry:\n")
+    out.write(" *      - Zobrist hash\n")
+    out.write(" *      - Number of moves for this position\n")
+    out.write(" *        For each move:\n")
+    out.write(" *         - Encoded move\n*/\n\n")
+
+
+    out.write("@inline\n")
+    out.write("export function getOpeningBookU32(index: u32): u32 {\n")
+    out.write("  return load<u32>(openingBookData + index * 4);\n")
+    out.write("}\n\n")
+
+    out.write("@inline\n")
+    out.write("export function getOpeningBookI32(index: u32): i32 {\n")
+    out.write("  return load<i32>(openingBookData + index * 4);\n")
+    out.write("}\n\n")
+
+    out.write("const openingBookData = memory.data<u32>([ ")
+
+    book_data = np.asarray(book, dtype=np.uint32)
+    is_hex_entry = book_data > 65535
+    text_entries = np.where(is_hex_entry, np.char.mod("%#x", book_data), book_data.astype(str))
+
+    # Each entry is written together with its preceding ", " separator
+    separators = np.full(len(book_data), ", ", dtype="<U8")
+    separators[0] = ""
+    if len(book_data) > 1:
+        separators[1] += "\n  "
+
+    # chars_written[idx]: number of characters written before entry idx, if the current line started at index 0
+    chars_written = np.concatenate(([0], np.cumsum(np.char.str_len(text_entries) + 2)))
+    hex_indices = np.flatnonzero(is_hex_entry)
+    hex_chars_written = chars_written[hex_indices]
+
+    # Wrap lines after 100 characters (or after 88 characters, if the next entry is a 32-bit hex value)
+    line_start = 0
+    while True:
+        first_wrap_idx = max(line_start, max_ply) + 1
+        line_chars = chars_written[line_start]
 
-            isWhiteTurn = board.turn == chess.WHITE
-            isBlackTurn = not isWhiteTurn
+        wrap_idx = max(np.searchsorted(chars_written, line_chars + 100), first_wrap_idx)
 
-            board.push(move)
+        hex_idx = max(np.searchsorted(hex_chars_written, line_chars + 88), np.searchsorted(hex_indices, first_wrap_idx))
+        if hex_idx < len(hex_indices):
+            wrap_idx = min(wrap_idx, hex_indices[hex_idx])
 
-            if (isWhiteTurn and not skipWhite) or (isBlackTurn and not skipBlack):
-                # Only include moves that were played in multiple games
-                if encoded_move in move_occurences[ply] and move_occurences[ply][encoded_move] >= move_thresholds[ply]:
-                    if ply > max_ply:
-                        max_ply = ply
+        if wrap_idx >= len(book_data):
+            break
 
-                    if zobrist_hash in ply_moves[ply]:
-                        ply_moves[ply][zobrist_hash].add(encoded_move)
-                    else:
-                        ply_moves[ply][zobrist_hash] = {encoded_move}
+        separators[wrap_idx] += "\n  "
+        line_start = wrap_idx
 
-                else:
-                    break
+    out.write("".join(np.char.add(separators, text_entries).tolist()))
+    out.write("\n]);\n")
+    out.close()
+    print("Success!")
 
-            ply += 1
+    for ply in range(max_ply):
+        occurences = move_occurences[ply]
+        if len(occurences) > 0:
+            values = np.fromiter(occurences.values(), dtype=np.int64, count=len(occurences))
+            print(ply, values.max(), int(np.median(values)), int(values.mean()))
+
+    print(move_thresholds)
+
+    print("Memory usage for book data: ", (len(book) * 4) / 1024, "KB")
 
-            if ply > PLY_BOOK_LIMIT:
-                break
-    pgn.close()
 
-print("Preparing opening book list...")
-
-book = [0 for _ in range(max_ply + 1)]
-book[0] = max_ply
-
-for idx in range(max_ply):
-    if len(ply_moves[idx]) == 0:
-        break
-    book[idx + 1] = len(book)         # Start index for the move list of the current ply
-    book.append(len(ply_moves[idx]))  # Number of entries (positions)
-    for zobrist_hash, moves in ply_moves[idx].items():
-        # Split 64 bit hash into 2 32-bit entries
-        for i in range(2):
-            book.append(zobrist_hash & np.uint64(0xFFFFFFFF))
-            zobrist_hash = np.uint64(zobrist_hash >> np.uint64(32))
-
-        book.append(len(moves))
-        book.extend(moves)
-
-print("Writing opening book list...")
-
-out = open("../../assembly/opening-book-data.ts", "w")
-out.write("/*\n")
-out.write(" * A free and open source chess game using AssemblyScript and React\n")
-out.write(" * Copyright (C) 2020 mhonert (https://github.com/mhonert)\n")
-out.write(" *\n")
-out.write(" * This program is free software: you can redistribute it and/or modify\n")
-out.write(" * it under the terms of the GNU General Public License as published by\n")
-out.write(" * the Free Software Foundation, either version 3 of the License, or\n")
-out.write(" * (at your option) any later version.\n")
-out.write(" *\n")
-out.write(" * This program is distributed in the hope that it will be useful,\n")
-out.write(" * but WITHOUT ANY WARRANTY; without even the implied warranty of\n")
-out.write(" * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the\n")
-out.write(" * GNU General Public License for more details.\n")
-out.write(" *\n")
-out.write(" * You should have received a copy of the GNU General Public License\n")
-out.write(" * along with this program.  If not, see <https://www.gnu.org/licenses/>.\n*/\n\n")
-
-out.write("/* _________________________________________________________________________\n\n")
-out.write(" * Auto-generated opening book data file\n")
-out.write(" *  Format:\n")
-out.write(" *  Index\n")
-out.write(" *  0: Number of plies in this book (BOOK_PLIES)\n")
-out.write(" *  1 - BOOK_PLIES: Start index for the moves for this ply\n\n")
-out.write(" *  For each ply:\n")
-out.write(" *   - Number of entries for this ply\n")
-out.write(" *     For each entry:\n")
-out.write(" *      - Zobrist hash\n")
-out.write(" *      - Number of moves for this position\n")
-out.write(" *        For each move:\n")
-out.write(" *         - Encoded move\n*/\n\n")
-
-
-out.write("@inline\n")
-out.write("export function getOpeningBookU32(index: u32): u32 {\n")
-out.write("  return load<u32>(openingBookData + index * 4);\n")
-out.write("}\n\n")
-
-out.write("@inline\n")
-out.write("export function getOpeningBookI32(index: u32): i32 {\n")
-out.write("  return load<i32>(openingBookData + index * 4);\n")
-out.write("}\n\n")
-
-out.write("const openingBookData = memory.data<u32>([ ")
-
-charsWritten = 0
-for idx, entry in enumerate(book):
-    if idx > 0:
-        charsWritten += 2
-        out.write(", ")
-
-    if idx == 1:
-        out.write("\n  ")
-
-    if idx > max_ply and (charsWritten >= 100 or entry > 65535 and charsWritten >= 88):
-        charsWritten = 0
-        out.write("\n  ")
-
-    text_entry = hex(entry) if entry > 65535 else str(entry)
-
-    out.write(text_entry)
-    charsWritten += len(text_entry)
-
-out.write("\n]);\n")
-out.close()
-print("Success!")
-
-for ply in range(max_ply):
-    occurences = move_occurences[ply]
-    if len(occurences) > 0:
-        values = move_occurences[ply].values()
-        print(ply,  max(values), int(statistics.median(values)), int(statistics.mean(values)))
-
-print(move_thresholds)
-
-print("Memory usage for book data: ", (len(book) * 4) / 1024, "KB")
+# Main
+if __name__ == "__main__":
+    main()
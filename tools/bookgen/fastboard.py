@@ -0,0 +1,109 @@
+# A free and open source chess game using AssemblyScript and React
+# Copyright (C) 2020 mhonert (https://github.com/mhonert)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import chess
+
+from zobrist import board_pieces, castling_bits, en_passant_key, hash_pieces, piece_key, CASTLING_RNG_NUMBERS, \
+    PLAYER_RNG_NUMBER, WHITE_KING_SIDE_CASTLING, BLACK_KING_SIDE_CASTLING, WHITE_QUEEN_SIDE_CASTLING, BLACK_QUEEN_SIDE_CASTLING
+
+WHITE_CASTLING = WHITE_KING_SIDE_CASTLING | WHITE_QUEEN_SIDE_CASTLING
+BLACK_CASTLING = BLACK_KING_SIDE_CASTLING | BLACK_QUEEN_SIDE_CASTLING
+
+# Castling rights, which are lost when a piece moves from or to the given square
+CASTLING_RIGHTS_BY_SQUARE = [0 for _ in range(64)]
+CASTLING_RIGHTS_BY_SQUARE[chess.A1] = WHITE_QUEEN_SIDE_CASTLING
+CASTLING_RIGHTS_BY_SQUARE[chess.H1] = WHITE_KING_SIDE_CASTLING
+CASTLING_RIGHTS_BY_SQUARE[chess.A8] = BLACK_QUEEN_SIDE_CASTLING
+CASTLING_RIGHTS_BY_SQUARE[chess.H8] = BLACK_KING_SIDE_CASTLING
+
+
+# Minimal board representation, which only tracks the state required for the zobrist hash of a position.
+# Moves are not validated, so this board must only be used to replay the (already validated) moves of a parsed game.
+class FastBoard:
+    __slots__ = ('squares', 'turn', 'castling', 'ep', 'hash')
+
+    def __init__(self, board):
+        pieces = board_pieces(board)
+
+        # Pieces (positive IDs for white, negative IDs for black) by python-chess square
+        self.squares = pieces.tolist()
+        self.turn = board.turn
+        self.castling = castling_bits(board.castling_rights)
+        self.ep = board.ep_square
+        self.hash = hash_pieces(pieces, self.turn, self.castling, self.ep)
+
+    def piece_type_at(self, sq):
+        return abs(self.squares[sq])
+
+    # Plays the given move and updates the zobrist hash incrementally
+    def make_move(self, move_from, move_to, promotion=None):
+        squares = self.squares
+        piece = squares[move_from]
+        captured = squares[move_to]
+        color = 1 if self.turn else -1
+        hash = self.hash
+
+        squares[move_from] = 0
+        hash ^= piece_key(piece, move_from)
+
+        if captured:
+            hash ^= piece_key(captured, move_to)
+
+        moved_piece = promotion * color if promotion else piece
+        squares[move_to] = moved_piece
+        hash ^= piece_key(moved_piece, move_to)
+
+        piece_type = piece * color
+        castling = self.castling & ~CASTLING_RIGHTS_BY_SQUARE[move_from] & ~CASTLING_RIGHTS_BY_SQUARE[move_to]
+
+        hash ^= en_passant_key(self.ep)
+        ep = None
+
+        if piece_type == chess.PAWN:
+            if abs(move_to - move_from) == 16:
+                ep = move_from + 8 * color
+
+            elif move_to == self.ep and not captured and (move_to & 7) != (move_from & 7):
+                capture_square = move_to - 8 * color
+                squares[capture_square] = 0
+                hash ^= piece_key(-piece, capture_square)
+
+        elif piece_type == chess.KING:
+            castling &= ~(WHITE_CASTLING if self.turn else BLACK_CASTLING)
+
+            if abs(move_to - move_from) == 2:
+                rook = chess.ROOK * color
+                if move_to > move_from:
+                    rook_from = move_from + 3
+                    rook_to = move_from + 1
+                else:
+                    rook_from = move_from - 4
+                    rook_to = move_from - 1
+
+                squares[rook_from] = 0
+                squares[rook_to] = rook
+                hash ^= piece_key(rook, rook_from) ^ piece_key(rook, rook_to)
+
+        if castling != self.castling:
+            hash ^= CASTLING_RNG_NUMBERS[self.castling] ^ CASTLING_RNG_NUMBERS[castling]
+            self.castling = castling
+
+        self.ep = ep
+        hash ^= en_passant_key(ep)
+        hash ^= PLAYER_RNG_NUMBER
+
+        self.turn = not self.turn
+        self.hash = hash
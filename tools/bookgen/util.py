@@ -15,15 +15,17 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 # Convert from python-chess board location to Wasabi chess engine location system
-import numpy as np
+from numba import njit, int8, uint16
 
 
 # Convert from python-chess board position to Wasabi engine board position
+@njit(int8(int8), cache=True)
 def square_to_bb(sq):
-    return (7 - int(sq / 8)) * 8 + (sq & 7)
+    return (7 - (sq >> 3)) * 8 + (sq & 7)
 
 
 # Encode piece ID, from and to board position of a move as a single 16 bit unsigned integer
+@njit(uint16(int8, int8, int8), cache=True)
 def encode_move(piece_id, move_from, move_to):
     bb_from = square_to_bb(move_from)
     bb_to = square_to_bb(move_to)
@@ -32,23 +34,24 @@ def encode_move(piece_id, move_from, move_to):
 
 # Right-rotate the bits of a 32 Bit integer
 def rotr32(n, rotations):
-    return np.uint32(n >> rotations) | (n << (32 - rotations))
+    return ((n >> rotations) | (n << (32 - rotations))) & 0xFFFFFFFF
 
 
 # Calculate pseudo-random numbers
+# Uses native Python integers with explicit masking, which is much faster than NumPy scalar arithmetic
 class Random:
 
-    state = np.uint64(0x4d595df4d0f33173)
-    multiplier = np.uint64(6364136223846793005)
-    increment = np.uint64(1442695040888963407)
+    state = 0x4d595df4d0f33173
+    multiplier = 6364136223846793005
+    increment = 1442695040888963407
 
     def rand32(self):
         x = self.state
-        count = np.uint32(x >> np.uint64(59))
-        self.state = x * self.multiplier + self.increment
-        x ^= x >> np.uint64(18)
+        count = x >> 59
+        self.state = (x * self.multiplier + self.increment) & 0xFFFFFFFFFFFFFFFF
+        x ^= x >> 18
 
-        return np.uint32(rotr32(np.uint32(x >> np.uint64(27)), count))
+        return rotr32((x >> 27) & 0xFFFFFFFF, count)
 
     def rand64(self):
-        return (np.uint64(self.rand32()) << np.uint64(32)) | np.uint64(self.rand32())
+        return (self.rand32() << 32) | self.rand32()
@@ -16,6 +16,7 @@
 
 import chess
 import numpy as np
+from numba import njit, boolean, int8, int64, uint64
 
 from util import square_to_bb, Random
 
@@ -24,50 +25,74 @@ BLACK_KING_SIDE_CASTLING = 1 << 1
 WHITE_QUEEN_SIDE_CASTLING = 1 << 2
 BLACK_QUEEN_SIDE_CASTLING = 1 << 3
 
-BIT_POS = [square_to_bb(sq) for sq in range(64)]
+# Wasabi engine board position by python-chess square
+BIT_POS = np.array([square_to_bb(sq) for sq in range(64)], dtype=np.uint8)
 
 
 # Calculates the zobrist hash for the current board position
 def calc_hash(board):
-    hash = np.uint64(0)
-    for idx, bitPos in enumerate(BIT_POS):
-        piece = board.piece_at(bitPos)
-        if piece:
-            if piece.color:
-                hash ^= (PIECE_RNG_NUMBERS[(piece.piece_type + 6) * 64 + idx])
+    return hash_pieces(board_pieces(board), board.turn, castling_bits(board.castling_rights), board.ep_square)
 
-            else:
-                hash ^= (PIECE_RNG_NUMBERS[(-piece.piece_type + 6) * 64 + idx])
 
-    if not board.turn:
-        hash ^= PLAYER_RNG_NUMBER
+# Returns the pieces (positive IDs for white, negative IDs for black) of a python-chess board by square
+def board_pieces(board):
+    pieces = np.zeros(64, dtype=np.int8)
+    for color in chess.COLORS:
+        for piece_type in chess.PIECE_TYPES:
+            piece = piece_type if color else -piece_type
+            for sq in chess.scan_forward(board.pieces_mask(piece_type, color)):
+                pieces[sq] = piece
 
-    castling_bits = 0
-    if board.castling_rights & chess.BB_A8:
-        castling_bits |= BLACK_QUEEN_SIDE_CASTLING
+    return pieces
 
-    if board.castling_rights & chess.BB_H8:
-        castling_bits |= BLACK_KING_SIDE_CASTLING
 
-    if board.castling_rights & chess.BB_H1:
-        castling_bits |= WHITE_KING_SIDE_CASTLING
+# Calculates the zobrist hash for the given pieces (see board_pieces), side to move, castling bits and en passant square
+def hash_pieces(pieces, turn, castling, ep_square):
+    ep_bit = -1 if ep_square is None else en_passant_bit(ep_square)
 
-    if board.castling_rights & chess.BB_A1:
-        castling_bits |= WHITE_QUEEN_SIDE_CASTLING
+    return int(_hash_core(pieces, turn, castling, ep_bit))
 
-    hash ^= CASTLING_RNG_NUMBERS[castling_bits]
 
-    if board.ep_square is not None:
-        ep_bit = 0
-        if chess.A3 <= board.ep_square <= chess.H3:
-            ep_bit |= ((board.ep_square - 16) + 8)
+# Returns the random number for a piece (positive IDs for white, negative IDs for black) on the given square
+def piece_key(piece, sq):
+    return PIECE_KEYS[piece + 6][sq]
 
-        if chess.A6 <= board.ep_square <= chess.H6:
-            ep_bit |= (board.ep_square - 40)
 
-        hash ^= EN_PASSANT_RNG_NUMBERS[ep_bit]
+# Converts python-chess castling rights to the castling state bits of the Wasabi engine
+def castling_bits(castling_rights):
+    bits = 0
+    if castling_rights & chess.BB_A8:
+        bits |= BLACK_QUEEN_SIDE_CASTLING
 
-    return hash
+    if castling_rights & chess.BB_H8:
+        bits |= BLACK_KING_SIDE_CASTLING
+
+    if castling_rights & chess.BB_H1:
+        bits |= WHITE_KING_SIDE_CASTLING
+
+    if castling_rights & chess.BB_A1:
+        bits |= WHITE_QUEEN_SIDE_CASTLING
+
+    return bits
+
+
+def en_passant_key(ep_square):
+    if ep_square is None:
+        return 0
+
+    return EN_PASSANT_RNG_NUMBERS[en_passant_bit(ep_square)]
+
+
+# Converts a python-chess en passant square to the en passant state bit of the Wasabi engine
+def en_passant_bit(ep_square):
+    ep_bit = 0
+    if chess.A3 <= ep_square <= chess.H3:
+        ep_bit |= ((ep_square - 16) + 8)
+
+    if chess.A6 <= ep_square <= chess.H6:
+        ep_bit |= (ep_square - 40)
+
+    return ep_bit
 
 
 rnd = Random()
@@ -81,12 +106,49 @@ def rand_array(count):
 
 
 def last_element_zero(elements):
-    elements[len(elements) - 1] = np.uint64(0)
+    elements[len(elements) - 1] = 0
     return elements
 
 
+# Random numbers as Python ints, used for the incremental hash updates
 PIECE_RNG_NUMBERS = rand_array(13 * 64)
 PLAYER_RNG_NUMBER = rnd.rand64()
 EN_PASSANT_RNG_NUMBERS = rand_array(16)
 
 CASTLING_RNG_NUMBERS = last_element_zero(rand_array(16))
+
+# The same random numbers as uint64 tables, used by the JIT-compiled hash calculation in _hash_core
+
+# Piece random numbers as a (piece + 6) x board position table
+PIECE_TABLE = np.array(PIECE_RNG_NUMBERS, dtype=np.uint64).reshape(13, 64)
+
+# Same as PIECE_TABLE, but indexed by python-chess square instead of Wasabi engine board position
+PIECE_HASH_TABLE = PIECE_TABLE[:, BIT_POS].copy()
+
+PLAYER_KEY = np.uint64(PLAYER_RNG_NUMBER)
+EN_PASSANT_TABLE = np.array(EN_PASSANT_RNG_NUMBERS, dtype=np.uint64)
+CASTLING_TABLE = np.array(CASTLING_RNG_NUMBERS, dtype=np.uint64)
+
+# PIECE_HASH_TABLE as nested lists of Python ints
+PIECE_KEYS = PIECE_HASH_TABLE.tolist()
+
+
+# Calculates the zobrist hash from a board with Wasabi engine piece IDs (positive for white, negative for black)
+# by python-chess square. ep_bit is -1, if no en passant capture is possible
+@njit(uint64(int8[::1], boolean, int64, int64), cache=True)
+def _hash_core(piece_board, turn, castling_bits, ep_bit):
+    hash = uint64(0)
+    for i in range(64):
+        piece = piece_board[i]
+        if piece != 0:
+            hash ^= PIECE_HASH_TABLE[piece + 6, i]
+
+    if not turn:
+        hash ^= PLAYER_KEY
+
+    hash ^= CASTLING_TABLE[castling_bits]
+
+    if ep_bit >= 0:
+        hash ^= EN_PASSANT_TABLE[ep_bit]
+
+    return hash
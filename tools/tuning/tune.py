@@ -14,17 +14,18 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 import logging as log
+import numpy as np
 import yaml
 import subprocess
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from time import time
 import sys
 import os
-from typing import List, Dict
+from typing import List, Dict, Iterator, Sequence
 import os.path
-import copy
 
 
 # Uses "Texel's Tuning Method" for tuning evaluation parameters
@@ -34,12 +35,19 @@ import copy
 # Scaling factor (calculated for Wasabi Chess engine)
 K = 1.342224
 
+# Use the faster libyaml based dumper, if available
+YAML_DUMPER = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
 
+# Maximum number of "eval" commands, which are sent to an engine before waiting for their scores
+PENDING_EVAL_CHUNKS = 2
+
+
+# Test positions stored as parallel lists/arrays (one entry per position)
 @dataclass
-class TestPosition:
-    fen: str
-    result: float
-    score: int = 0
+class TestSet:
+    fens: List[str]
+    results: np.ndarray  # float32
+    scores: np.ndarray  # int32
 
 
 @dataclass
@@ -58,8 +66,9 @@ class TuningOption:
 
 # Read test positions in format: FEN result
 # result may be "1-0" for a white win, "0-1" for a black win or "1/2" for a draw
-def read_fens(fen_file) -> List[TestPosition]:
-    test_positions = []
+def read_fens(fen_file) -> TestSet:
+    fens = []
+    results = []
     with open(fen_file, 'r') as file:
 
         # Sample line:
@@ -68,9 +77,10 @@ def read_fens(fen_file) -> List[TestPosition]:
             fen = line[:-5]
             result_str = line[-4:].strip()
             result = 1 if result_str == "1-0" else 0 if result_str == "0-1" else 0.5
-            test_positions.append(TestPosition(fen, result))
+            fens.append(fen)
+            results.append(result)
 
-    return test_positions
+    return TestSet(fens, np.array(results, dtype=np.float32), np.zeros(len(fens), dtype=np.int32))
 
 
 class Engine:
@@ -97,7 +107,8 @@ class Engine:
                 return line
 
 
-def run_engine(engine: Engine, tuning_options: List[TuningOption], test_positions: List[TestPosition]):
+# Evaluates the given test positions and stores the engine scores in "scores"
+def run_engine(engine: Engine, tuning_options: List[TuningOption], fens: List[str], scores: np.ndarray):
     results = []
 
     try:
@@ -110,24 +121,18 @@ def run_engine(engine: Engine, tuning_options: List[TuningOption], test_position
         engine.send_command("isready")
         engine.wait_for_command("readyok")
 
-        for chunk in make_chunks(test_positions, 100):
-            fens = "eval "
-            is_first = True
-            for pos in chunk:
-                if not is_first:
-                    fens += ";"
-                fens += pos.fen
-                is_first = False
-
-            engine.send_command(fens)
-
-            result = engine.wait_for_command("scores")
+        # Send the next chunk to the engine before reading the scores of the previous one,
+        # so the engine does not have to wait for the results to be processed
+        pending_chunks = deque()
+        for chunk, chunk_scores in zip(make_chunks(fens, 100), make_chunks(scores, 100)):
+            engine.send_command("eval " + ";".join(chunk))
+            pending_chunks.append(chunk_scores)
 
-            scores = [int(score) for score in result[len("scores "):].split(";")]
-            assert len(scores) == len(chunk)
+            if len(pending_chunks) >= PENDING_EVAL_CHUNKS:
+                read_scores(engine, pending_chunks.popleft())
 
-            for i in range(len(scores)):
-                chunk[i].score = scores[i]
+        while pending_chunks:
+            read_scores(engine, pending_chunks.popleft())
 
     except subprocess.TimeoutExpired as error:
         engine.stop()
@@ -139,15 +144,25 @@ def run_engine(engine: Engine, tuning_options: List[TuningOption], test_position
     return results
 
 
-# Split list of test positions into "batch_count" batches
-def make_batches(positions: List[TestPosition], batch_count: int) -> List[List[TestPosition]]:
+# Reads the scores for the oldest pending "eval" command
+def read_scores(engine: Engine, chunk_scores: np.ndarray):
+    result = engine.wait_for_command("scores")
+
+    scores = [int(score) for score in result[len("scores "):].split(";")]
+    assert len(scores) == len(chunk_scores)
+
+    chunk_scores[:] = scores
+
+
+# Split test positions (or their scores) into "batch_count" batches
+def make_batches(positions: Sequence, batch_count: int) -> Iterator[Sequence]:
     max_length = len(positions)
     batch_size = max(1, max_length // batch_count)
     return make_chunks(positions, batch_size)
 
 
-# Split list of test positions into chunks of size "chunk_size"
-def make_chunks(positions: List[TestPosition], chunk_size: int) -> List[List[TestPosition]]:
+# Split test positions (or their scores) into chunks of size "chunk_size"
+def make_chunks(positions: Sequence, chunk_size: int) -> Iterator[Sequence]:
     max_length = len(positions)
     for i in range(0, max_length, chunk_size):
         yield positions[i:min(i + chunk_size, max_length)]
@@ -211,16 +226,17 @@ class Config:
         cfg_stream.close()
 
 
-def run_pass(config: Config, k: float, engines: List[Engine], test_positions: List[TestPosition]) -> float:
+def run_pass(config: Config, k: float, engines: List[Engine], test_set: TestSet) -> float:
     futures = []
 
     log.debug("Starting pass")
 
     with ThreadPoolExecutor(max_workers=config.concurrent_workers) as executor:
         worker_id = 1
-        for batch in make_batches(test_positions, config.concurrent_workers):
+        for batch, batch_scores in zip(make_batches(test_set.fens, config.concurrent_workers),
+                                       make_batches(test_set.scores, config.concurrent_workers)):
             engine = engines[worker_id - 1]
-            futures.append(executor.submit(run_engine, engine, worker_id, config.tuning_options, batch))
+            futures.append(executor.submit(run_engine, engine, config.tuning_options, batch, batch_scores))
             worker_id += 1
 
         for future in as_completed(futures):
@@ -229,19 +245,15 @@ def run_pass(config: Config, k: float, engines: List[Engine], test_positions: Li
 
     log.debug("Pass completed")
 
-    e = calc_avg_error(k, test_positions)
+    e = calc_avg_error(k, test_set)
 
     return e
 
 
-def calc_avg_error(k: float, positions: List[TestPosition]) -> float:
-    errors = .0
-    for pos in positions:
-        win_probability = 1.0 / (1.0 + 10.0 ** (-pos.score * k / 400.0))
-        error = pos.result - win_probability
-        error *= error
-        errors += error
-    return errors / float(len(positions))
+def calc_avg_error(k: float, test_set: TestSet) -> float:
+    win_probabilities = 1.0 / (1.0 + np.power(10.0, -test_set.scores * (k / 400.0)))
+    errors = test_set.results - win_probabilities
+    return float(np.mean(errors * errors))
 
 
 def write_options(options: List[TuningOption]):
@@ -260,7 +272,7 @@ def write_options(options: List[TuningOption]):
             results.append({"name": option.name, "value": option.value})
 
     with open("tuning_result.yml", "w") as file:
-        yaml.dump(results, file, sort_keys=True, indent=4)
+        yaml.dump(results, file, Dumper=YAML_DUMPER, sort_keys=True, indent=4)
 
 
 def main():
@@ -272,8 +284,8 @@ def main():
 
     log.info("Reading test positions ...")
 
-    test_positions = read_fens(config.test_positions_file)
-    log.info("Read %i test positions", len(test_positions))
+    test_set = read_fens(config.test_positions_file)
+    log.info("Read %i test positions", len(test_set.fens))
 
     # Start multiple engines
     engines = []
@@ -283,10 +295,10 @@ def main():
 
     try:
 
-        best_err = run_pass(config, K, engines, test_positions)
+        best_err = run_pass(config, K, engines, test_set)
         init_err = best_err
         log.info("Starting err: %f", init_err)
-        best_options = copy.deepcopy(config.tuning_options)
+        best_options = [replace(option) for option in config.tuning_options]
 
         tick = time()
 
@@ -307,25 +319,25 @@ def main():
 
                 prev_value = option.value
                 option.value = prev_value + option.steps * option.direction
-                new_err = run_pass(config, K, engines, test_positions)
+                new_err = run_pass(config, K, engines, test_set)
                 log.info("Try %s = %d [step %d] => %f", option.name, option.value, option.steps * option.direction, new_err - best_err)
                 if new_err < best_err:
                     best_err = new_err
                     option.improvements += 1
                     option.skip_count = 0
-                    best_options = copy.deepcopy(config.tuning_options)
+                    best_options = [replace(option) for option in config.tuning_options]
                     log.info("Improvement: %f", best_err)
                     improved = True
                 else:
                     option.value = prev_value + option.steps * -option.direction
-                    new_err = run_pass(config, K, engines, test_positions)
+                    new_err = run_pass(config, K, engines, test_set)
                     log.info("Try %s = %d [step %d] => %f", option.name, option.value, option.steps * -option.direction, new_err - best_err)
                     if new_err < best_err:
                         best_err = new_err
                         option.direction = -option.direction
                         option.improvements += 1
                         option.skip_count = 0
-                        best_options = copy.deepcopy(config.tuning_options)
+                        best_options = [replace(option) for option in config.tuning_options]
                         log.info("Improvement: %f", best_err)
                         improved = True
                     else: